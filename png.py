@@ -1,51 +1,126 @@
-from binascii import crc32
+from concurrent.futures import ThreadPoolExecutor
+from mmap import mmap, ACCESS_READ
+from struct import Struct, pack, unpack_from
+from traceback import clear_frames
+
+# Prefer ISA-L's CRC-32 (PCLMULQDQ folding with runtime CPU dispatch) when it is installed,
+# otherwise fall back to the standard library implementation
+try:
+    from isal.isal_zlib import crc32
+except ImportError:
+    from binascii import crc32
 
 _PNG_HEADER = b'\x89\x50\x4e\x47\x0d\x0a\x1a\x0a'
 _PNG_FOOTER = b'IEND\xae\x42\x60\x82'
-CRITICAL_CHUNKS = (b'IHDR', b'PLTE', b'IDAT', b'IEND')
-ANCILLARY_CHUNKS = (b'bKGD', b'cHRM', b'dSIG', b'eXIF', b'gAMA', b'hIST', b'iCCP', b'iTXt',
-                    b'pHYs', b'sBIT', b'sPLT', b'sRGB', b'sTER', b'tEXt', b'tIME', b'tRNS', b'zTXt')
+CRITICAL_CHUNKS = frozenset((b'IHDR', b'PLTE', b'IDAT', b'IEND'))
+ANCILLARY_CHUNKS = frozenset((b'bKGD', b'cHRM', b'dSIG', b'eXIF', b'gAMA', b'hIST', b'iCCP', b'iTXt',
+                              b'pHYs', b'sBIT', b'sPLT', b'sRGB', b'sTER', b'tEXt', b'tIME', b'tRNS', b'zTXt'))
+# Category of every known chunk type, so one lookup both validates and categorizes a chunk
+_CHUNK_CATEGORIES = {**{chunk_type: 'Critical' for chunk_type in CRITICAL_CHUNKS},
+                     **{chunk_type: 'Ancillary' for chunk_type in ANCILLARY_CHUNKS}}
+_REQUIRED_CHUNKS = frozenset((b'IHDR', b'IDAT', b'IEND'))
+_CHUNK_HEADER = Struct('>I4s')  # Chunk size and type
 
 
 class Chunk:
+    # A PNG can be split into hundreds of chunks, so skip the per-instance __dict__
+    __slots__ = ('size', 'type', '_data', 'crc32', '_dirty')
+
     def __init__(self, init_type=b'', init_data=b''):
-        self.size = len(init_data).to_bytes(4, byteorder='big')
+        self.size = len(init_data)  # Stored as an int, only converted to bytes on export
         self.type = init_type
         self.data = init_data
         self.crc32 = b''
         self.calculate_crc32()
+        self._dirty = False  # True when data has changed since crc32 was last computed
+
+    # Build a chunk from fields read out of a PNG, keeping its original CRC rather than computing one
+    @classmethod
+    def from_parsed(cls, size, chunk_type, data, crc):
+        chunk = cls.__new__(cls)
+        chunk.size = size
+        chunk.type = chunk_type
+        chunk._data = data
+        chunk.crc32 = crc
+        chunk._dirty = False
+        return chunk
+
+    @property
+    def data(self):
+        return self._data
+
+    # Assigning new data marks the CRC as out of date. Edit data in place with set_bytes() rather than through the
+    # object returned by this property, since in-place changes made that way can't be detected
+    @data.setter
+    def data(self, new_data):
+        self._data = new_data
+        self._dirty = True
+
+    # Overwrite the bytes starting at index with new_bytes. Data parsed from a PNG is a read-only view (and bytes can't
+    # be changed in place), so it's copied into a bytearray on the first write; every write after that only touches the
+    # bytes being changed
+    def set_bytes(self, index, new_bytes):
+        if not isinstance(self._data, bytearray):
+            self._data = bytearray(self._data)
+        self._data[index:index + len(new_bytes)] = new_bytes
+        self._dirty = True
+
+    # CRC-32 covers type + data; seeding the data CRC with the type CRC avoids concatenating the two
+    def compute_crc32(self):
+        return pack('>I', crc32(self.data, crc32(self.type)))
 
     def calculate_crc32(self):
-        self.crc32 = crc32(self.type + self.data).to_bytes(4, byteorder='big')
+        self.crc32 = self.compute_crc32()
 
     def int_size(self):
-        return int.from_bytes(self.size, byteorder='big')
+        return self.size
+
+    # Recalculate the CRC only if the data was modified since it was last calculated
+    def refresh_crc32(self):
+        if self._dirty:
+            self.calculate_crc32()
+            self._dirty = False
+
+    # Number of bytes the chunk takes up when exported
+    def export_size(self):
+        return 8 + len(self.data) + len(self.crc32)
+
+    # Write the chunk into buffer starting at offset, returning the offset just past it. The CRC must already be up to
+    # date (see refresh_crc32)
+    def pack_into(self, buffer, offset):
+        _CHUNK_HEADER.pack_into(buffer, offset, self.size, self.type)
+        offset += 8
 
-    # Return the chunk as you would see it in a hex editor
+        buffer[offset:offset + len(self.data)] = self.data
+        offset += len(self.data)
+
+        buffer[offset:offset + len(self.crc32)] = self.crc32
+        return offset + len(self.crc32)
+
+    # Return the chunk as you would see it in a hex editor, as a (mutable) bytearray
     def export_chunk(self):
-        self.calculate_crc32()
-        return self.size + self.type + self.data + self.crc32
+        self.refresh_crc32()
+        output = bytearray(self.export_size())
+        self.pack_into(output, 0)
+        return output
 
 
 class PNG:
-    def __init__(self, data, verbose=False):
+    def __init__(self, data, verbose=False, verify=False):
         self.__verbose__ = verbose
         self.__encoding__ = 'utf-8'
         if data[:len(_PNG_HEADER)] != _PNG_HEADER or data[len(data) - len(_PNG_FOOTER):] != _PNG_FOOTER:
             raise Exception('Valid PNG header and/or footer not found')
 
         self.__split_chunks__(data)
+        if verify is True:
+            self.__verify_crc32s__()
         header_chunk = self.get_chunk_by_type(b'IHDR')
         meta_info = header_chunk.data
 
-        # Process metadata, converting bytes to ints
-        self.width = int.from_bytes(meta_info[0:4], byteorder='big')
-        self.height = int.from_bytes(meta_info[4:8], byteorder='big')
-        self.bit_depth = int.from_bytes(meta_info[8:9], byteorder='big')
-        self.color_type = int.from_bytes(meta_info[9:10], byteorder='big')
-        self.compression_method = int.from_bytes(meta_info[10:11], byteorder='big')
-        self.filter_method = int.from_bytes(meta_info[11:12], byteorder='big')
-        self.interlace_method = int.from_bytes(meta_info[12:13], byteorder='big')
+        # Process metadata, converting bytes to ints (two 4-byte ints followed by five 1-byte ints)
+        self.width, self.height, self.bit_depth, self.color_type, self.compression_method, self.filter_method, \
+            self.interlace_method = unpack_from('>IIBBBBB', meta_info)
 
         self.__validate_chunks__()
 
@@ -54,14 +129,14 @@ class PNG:
 
         # Metadata verbose printing
         if self.__verbose__ is True:
-            print("Image width: {}px".format(self.width))
-            print("Image height: {}px".format(self.height))
-            print("Image bit depth: {}-bit".format(self.bit_depth))
-            print("Image color type: {}".format(self.color_type))
-            print("Image compression method: {}".format(self.compression_method))
-            print("Image filter method: {}".format(self.filter_method))
-            print("Image interlace method: {}".format(self.interlace_method))
-            print('Order of chunks: {}'.format([chunk.type for chunk in self.chunks]))
+            print(f"Image width: {self.width}px")
+            print(f"Image height: {self.height}px")
+            print(f"Image bit depth: {self.bit_depth}-bit")
+            print(f"Image color type: {self.color_type}")
+            print(f"Image compression method: {self.compression_method}")
+            print(f"Image filter method: {self.filter_method}")
+            print(f"Image interlace method: {self.interlace_method}")
+            print(f'Order of chunks: {[chunk.type for chunk in self.chunks]}')
 
     def get_chunk_by_type(self, chunk_type, bool_return_index=False):
         return_index = None
@@ -91,125 +166,146 @@ class PNG:
             return return_chunk
 
     # Accomplishes "self.chunks[chunk_index].data[index] = new_value.to_bytes(num_bytes, byteorder='big')", which is not
-    # allowed
+    # allowed on bytes or the read-only views made when parsing
     def set_value_at_index(self, chunk_index, index, new_value, num_bytes=1):
-        before_current = self.chunks[chunk_index].data[:index]
-        after_current = self.chunks[chunk_index].data[index + num_bytes:]
-        self.chunks[chunk_index].data = before_current + new_value.to_bytes(num_bytes, byteorder='big') + after_current
+        self.chunks[chunk_index].set_bytes(index, new_value.to_bytes(num_bytes, byteorder='big'))
 
     # Split PNG data up into chunks, categorize them by critical, ancillary, or unknown,
     # and return a list of all chunks + the indexes where each chunk was found
     # Format for returned chunks is [chunk size, chunk type, chunk data, CRC-32]
     def __split_chunks__(self, data):
         self.chunks = []
-
-        # skip PNG starting magic number
-        i = len(_PNG_HEADER)
-
-        # While there are still chunks to parse...
-        while i < len(data):
-            new_chunk = Chunk()
-            size = data[i:i + 4]
-            new_chunk.size = size
-
-            chunk_size = new_chunk.int_size()  # Gets current chunk size (in number of bytes)
-            i += 4  # move from size to type
-
-            chunk_type = data[i:i + 4]
-            new_chunk.type = chunk_type
-
-            # used in verbose printing and runtime warning
-            str_type = chunk_type.decode(self.__encoding__)
-            offset = hex(i)
-
-            if self.__verbose__ is True:
-                if chunk_type in CRITICAL_CHUNKS:
-                    print('Critical chunk "{}" of size {}B found at offset {}'.format(str_type, chunk_size, offset))
-                elif chunk_type in ANCILLARY_CHUNKS:
-                    print(
-                        'Ancillary chunk "{}" of size {}B found at offset {}!'.format(str_type, chunk_size, offset))
-
-            if chunk_type not in CRITICAL_CHUNKS and chunk_type not in ANCILLARY_CHUNKS:
-                raise RuntimeWarning(
-                    'Unknown chunk type "{}" of size {}B found at offset {}'.format(str_type, chunk_size, offset))
+        # Slicing a memoryview is O(1), so no field or payload is copied until it's needed as bytes
+        view = memoryview(data)
+
+        # First pass: walk only the size and type of each chunk to validate it and find where it starts.
+        # Names used on every iteration are bound to locals to keep the loop's per-chunk overhead down
+        chunk_headers = []  # (offset, size, type) of each chunk
+        found_types = set()  # Only used while parsing; self.chunks is what every lookup afterwards reads
+        unpack_header = _CHUNK_HEADER.unpack_from
+        verbose = self.__verbose__
+        end = len(view)
+        i = len(_PNG_HEADER)  # skip PNG starting magic number
+        while i < end:
+            if i + _CHUNK_HEADER.size > end:
+                raise RuntimeError('Truncated chunk header found at offset {}'.format(hex(i)))
+            chunk_size, chunk_type = unpack_header(view, i)
+
+            category = _CHUNK_CATEGORIES.get(chunk_type)
+            if category is None:
+                raise RuntimeWarning('Unknown chunk type "{}" of size {}B found at offset {}'.format(
+                    chunk_type.decode(self.__encoding__), chunk_size, hex(i + 4)))
+
+            # The type is only decoded and the message only built when it will be printed
+            if verbose is True:
+                str_type = chunk_type.decode(self.__encoding__)
+                print(f'{category} chunk "{str_type}" of size {chunk_size}B found at offset {i + 4:#x}')
 
             # Ensure no duplicate critical chunks (except IDAT)
-            if self.get_chunk_by_type(chunk_type) is not None \
-                    and chunk_type in CRITICAL_CHUNKS and chunk_type != b'IDAT':
+            if category == 'Critical' and chunk_type != b'IDAT' and chunk_type in found_types:
                 raise RuntimeError('Chunk of type {} already exists'.format(chunk_type))
 
-            i += 4  # move from type to data
-
-            chunk_data = data[i:i + chunk_size]
-            new_chunk.data = chunk_data
+            found_types.add(chunk_type)
+            chunk_headers.append((i, chunk_size, chunk_type))
+            i += 4 + 4 + chunk_size + 4  # size, type, data, and crc32
 
-            i += chunk_size  # move from data to crc32
+        # Second pass: make a Chunk object for each chunk found
+        for i, chunk_size, chunk_type in chunk_headers:
+            data_start = i + 8
+            crc_start = data_start + chunk_size
 
-            original_crc32 = data[i:i + 4]
-            new_chunk.crc32 = original_crc32
+            # Keep the CRC from the file so untouched chunks are exported without rescanning their data
+            self.chunks.append(Chunk.from_parsed(chunk_size, chunk_type,
+                                                 view[data_start:crc_start], view[crc_start:crc_start + 4].tobytes()))
 
-            i += 4  # move to next chunk
+        if verbose is True:
+            print(f"PNG split into {len(self.chunks)} chunks (counting header and footer)")
 
-            # Record the Chunk object we made
-            self.chunks.append(new_chunk)
+    # Compare the CRC of every chunk against the CRC stored in the file. Each CRC is independent and crc32 releases the
+    # GIL on large buffers, so they're computed on a thread pool
+    def __verify_crc32s__(self):
+        with ThreadPoolExecutor() as executor:
+            computed_crc32s = executor.map(Chunk.compute_crc32, self.chunks)
 
-        if self.__verbose__ is True:
-            print("PNG split into {} chunks (counting header and footer)".format(len(self.chunks)))
+            for index, (chunk, computed_crc32) in enumerate(zip(self.chunks, computed_crc32s)):
+                if chunk.crc32 != computed_crc32:
+                    raise RuntimeError('CRC-32 mismatch in chunk {} of type {}'.format(
+                        index, chunk.type.decode(self.__encoding__)))
 
     # Called when reading and exporting to validate chunk counts
     def __validate_chunks__(self):
-        # Ensure required critical chunks exist
-        for chunk_type in (b'IHDR', b'IDAT', b'IEND'):
-            num_chunk = self.get_chunk_by_type(chunk_type)
+        # Ensure required critical chunks exist, with a special case for color_type = 3. The types are taken from the
+        # chunks themselves so that changes made to self.chunks after parsing are caught before exporting
+        found_types = {chunk.type for chunk in self.chunks}
+        missing_chunks = _REQUIRED_CHUNKS - found_types
+        if self.color_type == 3 and b'PLTE' not in found_types:
+            missing_chunks |= {b'PLTE'}
+
+        if missing_chunks:
+            str_version = ', '.join(sorted(chunk_type.decode(self.__encoding__) for chunk_type in missing_chunks))
+            raise RuntimeError('No {} chunk detected in PNG'.format(str_version))
+
+    # Return this PNG as a (mutable) bytearray to write to a file. The image is built in a single bytearray, which is
+    # returned as is rather than copied again into bytes
+    def export_image(self):
+        self.__validate_chunks__()
 
-            if num_chunk is None:
-                str_version = chunk_type.decode(self.__encoding__)
-                raise RuntimeError('No {} chunk detected in PNG'.format(str_version))
+        # CRCs are brought up to date first so the exported size of every chunk is known up front
+        for chunk in self.chunks:
+            chunk.refresh_crc32()
 
-        # Special case for color_type = 3
-        if self.color_type == 3 and self.get_chunk_by_type(b'PLTE') == -1:
-            raise RuntimeError('No {} chunk detected in PNG'.format(num_chunk.type.decode(self.__encoding__)))
+        # Copy each chunk straight into one pre-sized buffer instead of building and joining a byte-string per chunk
+        output = bytearray(len(_PNG_HEADER) + sum(chunk.export_size() for chunk in self.chunks))
+        output[:len(_PNG_HEADER)] = _PNG_HEADER
+        offset = len(_PNG_HEADER)
 
-    # Return byte-string representation of this PNG to write to a file
-    def export_image(self):
-        self.__validate_chunks__()
-        return _PNG_HEADER + b''.join([chunk.export_chunk() for chunk in self.chunks])
+        for chunk in self.chunks:
+            offset = chunk.pack_into(output, offset)
+
+        return output
 
 
 # A test of the PNG & Chunk classes by incrementing all green values in every pixel in a test image by 18 (max 255)
 def test_main():
-    with open('test.png', 'rb') as image:
-        data = image.read()
-    newPNG = PNG(data, verbose=True)
-
     color_name = 'g'
     color_to_change = 1
-
-    palette_index, palette_chunk = newPNG.get_chunk_by_type(b'PLTE', bool_return_index=True)
-
-    for color_index in range(1, int.from_bytes(palette_chunk.size, byteorder='big'), 3):
-        current_value = newPNG.chunks[palette_index].data[color_index]
-
-        if current_value == 255:
-            continue
-        print("Original {} value = {}".format(color_name, current_value))
-
-        increment = 18
-        if increment + current_value < 255:
-            new_value = increment + current_value
-        else:
-            new_value = 255
-
-        before_current = newPNG.chunks[palette_index].data[:color_index]
-        after_current = newPNG.chunks[palette_index].data[color_index + 1:]
-        newPNG.chunks[palette_index].data = before_current + new_value.to_bytes(1, byteorder='big') + after_current
-
-        print("New {} value = {}".format(color_to_change, new_value))
-
-        assert (current_value < new_value), 'Decrement failed'
+    increment = 18
+
+    # Lookup table mapping each byte value to itself plus the increment (max 255), so every green value in the palette
+    # can be changed with one translate() over the green channel instead of one Python-level write per value
+    increment_table = bytes(min(value + increment, 255) for value in range(256))
+
+    # Map the file rather than reading it so only the parts that are parsed get paged in. The map stays open only while
+    # the PNG (whose chunks are views into it) is in use
+    # The map can't be closed while views into it still exist, so they're all released before it is, even on errors
+    with open('test.png', 'rb') as image, mmap(image.fileno(), 0, access=ACCESS_READ) as data:
+        newPNG = palette_chunk = None
+        try:
+            newPNG = PNG(data, verbose=True)
+            palette_chunk = newPNG.get_chunk_by_type(b'PLTE')
+
+            palette = bytearray(palette_chunk.data)
+            original_values = palette[color_to_change::3]
+            new_values = original_values.translate(increment_table)
+            palette[color_to_change::3] = new_values
+            palette_chunk.data = palette  # Assigning data marks the palette's CRC to be recalculated on export
+
+            output_data = newPNG.export_image()
+        except Exception as error:
+            # The traceback keeps the locals of the frames that raised (such as the view in __split_chunks__) alive
+            clear_frames(error.__traceback__)
+            raise
+        finally:
+            del newPNG, palette_chunk
+
+    num_changed = sum(1 for current_value in original_values if current_value != 255)
+    print("Incremented {} {} values by {} (max 255)".format(num_changed, color_name, increment))
+
+    assert all(current_value < new_value for current_value, new_value in zip(original_values, new_values)
+               if current_value != 255), 'Decrement failed'
 
     with open('new.png', 'wb') as new_image:
-        new_image.write(newPNG.export_image())
+        new_image.write(output_data)
 
 
 if __name__ == '__main__':
@@ -107,9 +107,8 @@ def insert(carrier_obj, message):
 
     # FIXME: Storing message length in size of IEND chunk is stupid easy to detect
     # To keep track of the secret message's length, the message length is stored in the size of the IEND chunk
-    message_byte_len = len(message_numbers).to_bytes(4, byteorder='big')
     iend_index, iend_chunk = carrier_obj.get_chunk_by_type(b'IEND', bool_return_index=True)
-    carrier_obj.chunks[iend_index].size = message_byte_len
+    carrier_obj.chunks[iend_index].size = len(message_numbers)
     return carrier_obj
 
 